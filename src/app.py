@@ -1,16 +1,23 @@
+import asyncio
+import hashlib
+import logging
+import shutil
 import uuid
-from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal
-from io import BytesIO
-from os import environ
+from functools import partial
+from multiprocessing import get_context
+from os import cpu_count, environ, link
 from pathlib import Path
-from typing import Generator, List, Optional
+from time import monotonic, time
+from typing import List, Optional
 
-from dotenv import find_dotenv, load_dotenv
-from fastapi import BackgroundTasks, FastAPI, Request, Response
+import orjson
+from fastapi import FastAPI, Request
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, ORJSONResponse, RedirectResponse
 from jinja2 import Environment, PackageLoader, select_autoescape
 from pydantic import BaseModel, ConfigDict, Field
 from sqlmodel import select, text
@@ -18,16 +25,23 @@ from weasyprint import CSS, HTML
 from weasyprint.text.fonts import FontConfiguration
 
 from .database import Session, SQLModel, append_sample_data, engine
-from .models import ORDER_PREFIX, CurrencyEnum
+from .models import ORDER_PREFIX, Customer
 from .models import Order as dbOrder
-from .template_utils import datetime_format, handle_none, timestamp_format
+from .template_utils import (
+    DASH,
+    FMT,
+    datetime_format,
+    handle_none,
+    timestamp_format,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    env = find_dotenv(".env")
-    load_dotenv(env)
-    (Path(__file__).parent / "reports").mkdir(exist_ok=True)
+    (Path(__file__).parent / "reports/by_hash").mkdir(parents=True, exist_ok=True)
+    REPORT_INDEX.update(
+        item.stem for item in (Path(__file__).parent / "reports").glob("*.pdf")
+    )
     if environ.get("MAINTENANCE", "False") == "False":
         SQLModel.metadata.drop_all(engine)
         SQLModel.metadata.create_all(engine)
@@ -35,57 +49,65 @@ async def lifespan(app: FastAPI):
             session.exec(text("PRAGMA journal_mode=WAL;"))
             session.commit()
             append_sample_data(session)
+    app.state.render_pool = new_render_pool()
+    app.state.report_queue = asyncio.Queue()
+    consumer = asyncio.create_task(render_reports(app))
+    consumer.add_done_callback(log_consumer_exit)
     yield
+    consumer.cancel()
+    app.state.render_pool.shutdown(wait=True, cancel_futures=True)
 
 
-@contextmanager
-def db_session() -> Generator[Session, None, None]:
-    with Session(engine) as session:
-        try:
-            yield session
-        except Exception as e:
-            print(e)
-            session.rollback()
-        finally:
-            session.commit()
+def new_render_pool() -> ProcessPoolExecutor:
+    # Forking the threaded server can deadlock, so workers start from a clean
+    # process and open their own database connections
+    return ProcessPoolExecutor(
+        max_workers=cpu_count(), mp_context=get_context("forkserver")
+    )
 
 
-app = FastAPI(lifespan=lifespan)
-app.add_middleware(GZipMiddleware, minimum_size=3000, compresslevel=7)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=65536, compresslevel=1)
 
 
 @app.middleware("http")
 async def redirect_to_maintenance(request: Request, call_next):
     if environ.get("MAINTENANCE", "False") == "False":
         return await call_next(request)
-    response = JSONResponse(
+    response = ORJSONResponse(
         status_code=200, content={"message": "Server Unavailable due to maintenance"}
     )
     response.headers["X-Server-Mode"] = "Maintenance Mode"
     return response
 
 
-jinja_env = Environment(loader=PackageLoader("src"), autoescape=select_autoescape())
+jinja_env = Environment(
+    loader=PackageLoader("src"),
+    autoescape=select_autoescape(),
+    auto_reload=False,
+    cache_size=400,
+)
 jinja_env.filters["dt_format"] = datetime_format
 jinja_env.filters["ts_format"] = timestamp_format
 jinja_env.filters["handle_none"] = handle_none
-
-
-class BaseOrder(BaseModel):
-    uid: int
-    name: str
-    surname: str
-    initialized: int
-
-    @property
-    def uid_with_prefix(self) -> str:
-        return f"{ORDER_PREFIX}{self.uid}"
-
-
-class Order(BaseOrder):
-    amount: Optional[Decimal] = Field(default=None)
-    currency: CurrencyEnum = Field(default=CurrencyEnum.EUR)
-    finalized: Optional[int] = Field(default=None)
+BASE_TEMPLATE = jinja_env.get_template("base.html")
+
+FONT_CONFIG = FontConfiguration()
+PAGE_CSS = CSS(string="@page {margin: 1.5cm;}", font_config=FONT_CONFIG)
+STYLE_CSS = CSS(
+    filename=str(Path(__file__).parent / "templates/style.css"),
+    font_config=FONT_CONFIG,
+)
+logger = logging.getLogger("uvicorn.error")
+
+IMAGE_CACHE: dict = {}
+RENDER_JOBS: set[asyncio.Future] = set()
+REPORT_INDEX: set[str] = set()
+FAILED_REPORTS: set[str] = set()
+ORDERS_CACHE: Optional[tuple[float, List[dict]]] = None
+ORDERS_CACHE_TTL = 5
+RENDER_BATCH_SIZE = 32
+RENDER_BATCH_WINDOW = 0.05
 
 
 class BaseReport(BaseModel):
@@ -104,82 +126,180 @@ async def root():
 
 
 @app.post("/queue-report/")
-async def queue_report(background_tasks: BackgroundTasks) -> Report:
+async def queue_report(request: Request) -> Report:
     """Initialize pdf generation
     Return report uuid to use to get the result
     """
     report = Report()
-    background_tasks.add_task(generate_report, uid=report.uid)
+    request.app.state.report_queue.put_nowait(report.uid)
     return report
 
 
 @app.get("/reports")
 async def get_all_reports() -> List[str]:
-    return [
-        item.stem
-        for item in (Path(__file__).parent / "reports").iterdir()
-        if item.is_file() and item.suffix == ".pdf"
-    ]
+    return list(REPORT_INDEX)
 
 
 @app.get("/get-report/{uid}/")
 async def get_report(uid: uuid.UUID):
     """Return Generated Report PDF from list of orders"""
-    report_bytes: Optional[BytesIO] = await get_report_from_storage(uid)
-    if not report_bytes:
-        return JSONResponse(
+    if str(uid) in FAILED_REPORTS:
+        return ORJSONResponse(
+            status_code=500, content={"reason": f"Report with id {uid} failed."}
+        )
+    target_file = Path(__file__).parent / f"reports/{uid}.pdf"
+    if str(uid) not in REPORT_INDEX or not await asyncio.to_thread(target_file.exists):
+        return ORJSONResponse(
             status_code=404, content={"reason": f"Report with id {uid} not found."}
         )
-    return Response(
-        content=report_bytes.getvalue(),
-        status_code=200,
-        headers={
-            "Content-Disposition": 'attachment; filename="report.pdf"',
-            "Accept-Encoding": "gzip",
-        },
+    # PDF streams are already deflated, keep the gzip middleware away from them
+    return FileResponse(
+        target_file,
         media_type="application/pdf",
+        filename="report.pdf",
+        headers={"Content-Encoding": "identity"},
     )
 
 
-def gather_orders() -> List[Order]:
-    with db_session() as session:
-        results = session.exec(select(dbOrder).order_by(-dbOrder.initialized)).all()
-        print("Results: ", len(results))
-        return [
-            Order(
-                uid=order.uid,
-                name=order.customer.name,
-                surname=order.customer.surname,
-                amount=order.amount,
-                currency=order.currency,
-                initialized=order.initialized,
-                finalized=order.finalized,
+def gather_orders() -> List[dict]:
+    """Return the report rows with every field already formatted for display"""
+    global ORDERS_CACHE
+    if ORDERS_CACHE and monotonic() - ORDERS_CACHE[0] < ORDERS_CACHE_TTL:
+        return ORDERS_CACHE[1]
+    # Query errors must fail the render job rather than produce an empty report
+    with Session(engine) as session:
+        results = session.exec(
+            select(
+                dbOrder.uid,
+                dbOrder.amount,
+                dbOrder.currency,
+                dbOrder.initialized,
+                dbOrder.finalized,
+                Customer.name,
+                Customer.surname,
             )
-            for order in results
+            .outerjoin(Customer)
+            .order_by(dbOrder.initialized.desc())
+        ).all()
+        print("Results: ", len(results))
+        orders = [
+            {
+                "uid_prefixed": f"{ORDER_PREFIX}{uid}",
+                "name": DASH if name is None else name,
+                "surname": DASH if surname is None else surname,
+                "amount_str": DASH if amount is None else str(amount),
+                "currency": DASH if currency is None else str(currency),
+                "initialized_fmt": datetime.fromtimestamp(initialized).strftime(FMT),
+                "finalized_fmt": (
+                    DASH
+                    if finalized is None
+                    else datetime.fromtimestamp(finalized).strftime(FMT)
+                ),
+            }
+            for uid, amount, currency, initialized, finalized, name, surname in results
         ]
+    ORDERS_CACHE = (monotonic(), orders)
+    return orders
 
 
-def generate_report(uid: uuid.UUID) -> None:
-    template = jinja_env.get_template("base.html")
-    context = {
-        "when": (datetime.now(timezone.utc).astimezone() + timedelta(hours=3)),
-        "data": gather_orders(),
-    }
-    font_config = FontConfiguration()
-    css = CSS(string="@page {margin: 1.5cm;}", font_config=font_config)
-    HTML(string=template.render(context)).write_pdf(
-        Path(__file__).parent / f"reports/{uid}.pdf",
-        stylesheets=[
-            css,
-            Path(__file__).parent / "templates/style.css",
-        ],
-        font_config=font_config,
-    )
+def generate_report(uids: List[uuid.UUID]) -> None:
+    """Render the orders once and store the pdf under every requested uid
+    Reports of an unchanged order set are linked to a recently rendered pdf
+    """
+    data = gather_orders()
+    digest = hashlib.blake2b(orjson.dumps(data), digest_size=16).hexdigest()
+    by_hash = Path(__file__).parent / "reports/by_hash"
+    rendered = by_hash / f"{digest}.pdf"
+    prune_rendered(by_hash)
+    # The pdf carries its creation time, only reuse it while that is still current
+    if not is_fresh(rendered):
+        context = {
+            "when": (datetime.now(timezone.utc).astimezone() + timedelta(hours=3)),
+            "data": data,
+        }
+        content = HTML(string=BASE_TEMPLATE.render(context)).write_pdf(
+            stylesheets=[PAGE_CSS, STYLE_CSS],
+            font_config=FONT_CONFIG,
+            optimize_images=True,
+            cache=IMAGE_CACHE,
+        )
+        # Another worker may be rendering the same digest, only publish whole files
+        partial_file = rendered.with_suffix(f".{uuid.uuid4()}.tmp")
+        partial_file.write_bytes(content)
+        partial_file.replace(rendered)
+    for uid in uids:
+        target_file = Path(__file__).parent / f"reports/{uid}.pdf"
+        try:
+            link(rendered, target_file)
+        except OSError:
+            # Not every volume supports hard links
+            shutil.copyfile(rendered, target_file)
 
 
-async def get_report_from_storage(uid: uuid.UUID) -> Optional[BytesIO]:
-    """Return the body of the pdf report, if it exists"""
-    target_file = Path(__file__).parent / f"reports/{uid}.pdf"
-    if (target_file).exists():
-        return BytesIO(target_file.read_bytes())
-    return None
+def is_fresh(path: Path) -> bool:
+    try:
+        return time() - path.stat().st_mtime < ORDERS_CACHE_TTL
+    except FileNotFoundError:
+        return False
+
+
+def prune_rendered(directory: Path) -> None:
+    """Remove rendered pdfs well past reuse, stored reports are separate links"""
+    for item in directory.iterdir():
+        try:
+            if time() - item.stat().st_mtime > 2 * ORDERS_CACHE_TTL:
+                item.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue
+
+
+async def render_reports(app: FastAPI) -> None:
+    """Collect queued report uids within a short window and render them together"""
+    queue: asyncio.Queue[uuid.UUID] = app.state.report_queue
+    loop = asyncio.get_running_loop()
+    while True:
+        uids = [await queue.get()]
+        deadline = loop.time() + RENDER_BATCH_WINDOW
+        while len(uids) < RENDER_BATCH_SIZE:
+            try:
+                uids.append(await asyncio.wait_for(queue.get(), deadline - loop.time()))
+            except TimeoutError:
+                break
+        try:
+            job = submit_reports(app, uids)
+        except Exception:
+            logger.exception("Could not submit reports %s", uids)
+            FAILED_REPORTS.update(str(uid) for uid in uids)
+            continue
+        RENDER_JOBS.add(job)
+        job.add_done_callback(RENDER_JOBS.discard)
+        job.add_done_callback(partial(index_reports, uids))
+
+
+def submit_reports(app: FastAPI, uids: List[uuid.UUID]) -> asyncio.Future:
+    """Hand a batch to the render pool, replacing the pool if a worker died"""
+    loop = asyncio.get_running_loop()
+    try:
+        return loop.run_in_executor(app.state.render_pool, generate_report, uids)
+    except BrokenProcessPool:
+        logger.warning("Render pool is broken, starting a new one")
+        app.state.render_pool.shutdown(wait=False, cancel_futures=True)
+        app.state.render_pool = new_render_pool()
+        return loop.run_in_executor(app.state.render_pool, generate_report, uids)
+
+
+def index_reports(uids: List[uuid.UUID], job: asyncio.Future) -> None:
+    """Record the reports of a finished render job as available or failed"""
+    if job.cancelled():
+        return
+    if job.exception():
+        logger.error("Rendering reports %s failed", uids, exc_info=job.exception())
+        FAILED_REPORTS.update(str(uid) for uid in uids)
+        return
+    REPORT_INDEX.update(str(uid) for uid in uids)
+
+
+def log_consumer_exit(task: asyncio.Task) -> None:
+    """Make an unexpected stop of the report consumer visible"""
+    if not task.cancelled() and task.exception():
+        logger.error("Report consumer stopped", exc_info=task.exception())
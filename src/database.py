@@ -1,15 +1,38 @@
 import random
 from datetime import datetime, timedelta
 from decimal import Decimal
+from os import environ
 
-from sqlmodel import Session, SQLModel, create_engine, select  # noqa
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, insert, select  # noqa
 
 from . import models
 
+# The only place .env is loaded: engine settings are read at import and the app
+# module imports this one before reading any other variable
+load_dotenv(find_dotenv(".env"))
+
+# Reports render in worker processes, each with its own connections, so the
+# database has to be a file they can all open; "sqlite://" would be empty there
 sqlite_url = "sqlite:///data.db"
-# sqlite_url = "sqlite://"
 
-engine = create_engine(sqlite_url, echo=True)
+engine = create_engine(
+    sqlite_url,
+    echo=environ.get("SQL_ECHO", "False") == "True",
+    connect_args={"check_same_thread": False},
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Tune every new connection for the read-mostly report workload."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.execute("PRAGMA temp_store=MEMORY;")
+    cursor.execute("PRAGMA mmap_size=268435456;")
+    cursor.execute("PRAGMA cache_size=-65536;")
+    cursor.close()
 
 
 def append_sample_data(session: Session) -> None:
@@ -22,21 +45,14 @@ def append_sample_data(session: Session) -> None:
 
 def create_sample_customers(session: Session) -> None:
     customers = [
-        models.Customer(
-            name="Giorikas", surname="Alpha", contact_email="giorikas@alpha.com"
-        ),
-        models.Customer(
-            name="Kostikas", surname="Giota", contact_email="kostikas@giota.com"
-        ),
-        models.Customer(name="Makis", surname="Zita", contact_email="makis@zita.com"),
-        models.Customer(
-            name="Fotis", surname="ParaPente", contact_email="fotis@parapente.com"
-        ),
+        dict(name="Giorikas", surname="Alpha", contact_email="giorikas@alpha.com"),
+        dict(name="Kostikas", surname="Giota", contact_email="kostikas@giota.com"),
+        dict(name="Makis", surname="Zita", contact_email="makis@zita.com"),
+        dict(name="Fotis", surname="ParaPente", contact_email="fotis@parapente.com"),
     ]
 
     try:
-        for customer in customers:
-            session.add(customer)
+        session.exec(insert(models.Customer).values(customers))
     except Exception as e:
         print(e)
         session.rollback()
@@ -46,7 +62,7 @@ def create_sample_customers(session: Session) -> None:
 
 def create_sample_orders(session: Session) -> None:
     orders = [
-        models.Order(
+        dict(
             initialized=int(
                 (datetime.now() - timedelta(days=random.randint(0, 50))).timestamp()
             ),
@@ -59,8 +75,7 @@ def create_sample_orders(session: Session) -> None:
     ]
 
     try:
-        for order in orders:
-            session.add(order)
+        session.exec(insert(models.Order).values(orders))
     except Exception as e:
         print(e)
         session.rollback()
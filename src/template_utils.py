@@ -1,20 +1,22 @@
 from datetime import datetime
 from typing import Optional
 
+from markupsafe import Markup
 
-def datetime_format(value, format="%d/%m/%Y @ %H:%M:%S"):
-    return value.strftime(format) if value and isinstance(value, datetime) else None
+DASH = Markup("&dash;")
+FMT = "%d/%m/%Y @ %H:%M:%S"
 
+strftime = datetime.strftime
+fromtimestamp = datetime.fromtimestamp
 
-def timestamp_format(value, format="%d/%m/%Y @ %H:%M:%S") -> Optional[str]:
-    return (
-        datetime.fromtimestamp(value).strftime(format)
-        if value and isinstance(value, int)
-        else None
-    )
+
+def datetime_format(value, format=FMT):
+    return strftime(value, format) if value is not None else None
+
+
+def timestamp_format(value, format=FMT) -> Optional[str]:
+    return strftime(fromtimestamp(value), format) if value is not None else None
 
 
 def handle_none(value: Optional[str]) -> str:
-    if not value:
-        return "&dash;"
-    return value
+    return DASH if not value else value